@@ -1,23 +1,73 @@
 import os
-from telegram import Update, ForceReply
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
-from libs import ChordParser, Tuning
+import logging
+from telegram import Update, ForceReply, InlineQueryResultCachedPhoto
+from telegram.ext import Updater, CommandHandler, MessageHandler, InlineQueryHandler, Filters, CallbackContext
+from libs import ChordParser, ChordIndex, ChordFilter, Harmony, Popularity, Sender, Tuning, setup_logging
+from concurrent.futures import Future
+from collections import OrderedDict
 from io import BytesIO
+import threading
 
 
+logger = logging.getLogger('finga_bot')
+
 def noexceptions(fn):
     def wrapper(*args, **kwargs):
         try:
             res = fn(*args, **kwargs)
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('%s failed', fn.__name__)
             return None
         else:
             return res
     return wrapper
 
 class Bot:
+    MAX_CAPO = 12
+    MAX_FRET = 22
+
+    MAX_RENDERED = 256
+    PREWARM_TOP = 100
+    PREWARM_INTERVAL = 0.5
+    PREWARM_ATTEMPTS = 3
+    FLUSH_INTERVAL = 60
+
     user_settings = dict()
+    chord_index = ChordIndex()
+    chord_filter = ChordFilter()
+    # in memory only until create_updater is given a file
+    popularity = Popularity()
+    # settings key -> (title, jpeg), least recently used first
+    rendered = OrderedDict()
+    # draw runs on the dispatcher and on the job queue thread
+    rendered_lock = threading.Lock()
+    prewarm_queue = None
+    prewarm_upload = None
+    prewarm_attempts = dict()
+    sender = None
+
+    @classmethod
+    def reply_text(cls, update: Update, text, **kwargs) -> Future:
+        return cls.reply_all(update, [('message', text, kwargs)])[0]
+
+    @classmethod
+    def reply_all(cls, update: Update, messages) -> list:
+        """ ('message', text, kwargs) and ('photo', photo, kwargs) in one go """
+        if cls.sender is not None:
+            if messages and update.message:
+                # the first message of the batch replies to the user's one
+                kind, content, kwargs = messages[0]
+                kwargs = dict(kwargs, reply_to_message_id=update.message.message_id, allow_sending_without_reply=True)
+                messages = [(kind, content, kwargs)] + list(messages[1:])
+            return cls.sender.send_all(update.effective_chat.id, messages)
+        reply = dict(message=update.message.reply_text, photo=update.message.reply_photo)
+        return [cls.sent(reply[kind](content, **kwargs)) for kind, content, kwargs in messages]
+
+    @staticmethod
+    def sent(message) -> Future:
+        future = Future()
+        future.set_result(message)
+        return future
 
     @classmethod
     @noexceptions
@@ -30,16 +80,34 @@ class Bot:
           /help - this help ;)
           /tune <tuning> - change tuning, eg, "/tune EADG" for 4-string bass guitar
           /tune default - returns tuning to classic EBGDAE
+          /capo <fret> - put a capo on, eg, "/capo 2"; "/capo 0" takes it off
+          /frets <start>-<end> - show another part of the neck, eg, "/frets 5-12"
+          /frets default - returns to frets 0-11
+          /reverse - mirror the fret
+          /key <tonic> [major|minor|mode] - all chords of a key, eg, "/key A minor" or "/key D dorian"
+
+        Inline mode: type "@<bot> Am" in any chat to pick a chord diagram,
+        chords not drawn yet are offered to be drawn here first
             
         """
-        update.message.reply_text(help_text)
+        cls.reply_text(update, help_text)
+
+    @classmethod
+    @noexceptions
+    def start(cls, update: Update, context: CallbackContext) -> None:
+        """ /start, or a deep link from inline mode with a chord to draw """
+        chord_name = ChordIndex.from_start_parameter(context.args[0]) if context.args else None
+        if chord_name is None:
+            cls.help(update, context)
+            return
+        cls.reply_chords(update, [chord_name])
 
     @classmethod
     @noexceptions
     def tune(cls, update: Update, context: CallbackContext) -> None:
         user = update.effective_user.id
         if not len(context.args):
-            update.message.reply_text('tuning cannot be empty')
+            cls.reply_text(update, 'tuning cannot be empty')
             return
 
         try:
@@ -47,18 +115,19 @@ class Bot:
             if tuning_name.upper() == 'DEFAULT':
                 if cls.user_settings.get(user, {}).get('tuning') is not None:
                     del cls.user_settings[user]['tuning']
-                update.message.reply_text('tuning is set to default (EBGDAE)')
+                cls.reply_text(update, 'tuning is set to default (EBGDAE)')
                 return
 
             tuning = Tuning(name=tuning_name)
         except ValueError:
-            response = 'invalid tuning {}'.format(context.args[0])
+            response = 'invalid tuning {}, up to {} strings of A-G, # and b'.format(
+                context.args[0][:2 * Tuning.MAX_STRINGS], Tuning.MAX_STRINGS)
         else:
             if cls.user_settings.get(user) is None:
                 cls.user_settings[user] = dict()
             cls.user_settings[user]['tuning'] = tuning
             response = 'tuning is set to {}'.format(tuning)
-        update.message.reply_text(response)
+        cls.reply_text(update, response)
 
     @classmethod
     @noexceptions
@@ -70,51 +139,327 @@ class Bot:
             cls.user_settings[user]['reverse'] = False
         cls.user_settings[user]['reverse'] = not cls.user_settings[user]['reverse']
         reverse = cls.user_settings[user]['reverse']
-        update.message.reply_text('fret is now {} mirrored'.format('' if reverse else 'not'))
+        cls.reply_text(update, 'fret is now {} mirrored'.format('' if reverse else 'not'))
+
+    @classmethod
+    @noexceptions
+    def capo(cls, update: Update, context: CallbackContext) -> None:
+        user = update.effective_user.id
+        try:
+            kapo = int(context.args[0])
+            if not 0 <= kapo <= cls.MAX_CAPO:
+                raise ValueError
+        except (IndexError, ValueError):
+            cls.reply_text(update, 'capo must be a fret from 0 to {}'.format(cls.MAX_CAPO))
+            return
+
+        start, end = cls.user_settings.get(user, {}).get('frets', (0, 11))
+        if kapo + start > cls.MAX_FRET:
+            cls.reply_text(update, 'capo on fret {} leaves nothing of frets {}-{}, change them first'.format(
+                kapo, start, end))
+            return
+
+        if cls.user_settings.get(user) is None:
+            cls.user_settings[user] = dict()
+        cls.user_settings[user]['kapo'] = kapo
+        response = 'capo is set to fret {}'.format(kapo) if kapo else 'capo is removed'
+        cls.reply_text(update, response + cls.window_cut(kapo, end))
+
+    @classmethod
+    @noexceptions
+    def frets(cls, update: Update, context: CallbackContext) -> None:
+        user = update.effective_user.id
+        window = ' '.join(context.args).strip()
+        if window.upper() == 'DEFAULT':
+            if cls.user_settings.get(user, {}).get('frets') is not None:
+                del cls.user_settings[user]['frets']
+            cls.reply_text(update, 'frets are set to default (0-11)')
+            return
+
+        try:
+            start, end = (int(fret) for fret in window.replace('-', ' ').split())
+            if not 0 <= start <= end <= cls.MAX_FRET:
+                raise ValueError
+        except ValueError:
+            cls.reply_text(update, 'invalid frets {}, eg, "/frets 5-12"'.format(window))
+            return
+
+        kapo = cls.user_settings.get(user, {}).get('kapo', 0)
+        if kapo + start > cls.MAX_FRET:
+            cls.reply_text(update, 'with the capo on fret {} frets go up to {}'.format(kapo, cls.MAX_FRET - kapo))
+            return
+
+        if cls.user_settings.get(user) is None:
+            cls.user_settings[user] = dict()
+        cls.user_settings[user]['frets'] = start, end
+        cls.reply_text(update, 'frets are set to {}-{}'.format(start, end) + cls.window_cut(kapo, end))
+
+    @classmethod
+    def window_cut(cls, kapo, end) -> str:
+        """ a note for the user if the neck ends inside their window """
+        if kapo + end <= cls.MAX_FRET:
+            return ''
+        return ', the window is cut at fret {} by the end of the neck'.format(cls.MAX_FRET - kapo)
 
     @classmethod
     @noexceptions
     def explain(cls, update: Update, context: CallbackContext) -> None:
-        chord_names = update.message.text.split(',')
+        text = update.message.text
+        chord_names = cls.chord_filter.split(text)
+        if chord_names is None:
+            # ordinary conversation in groups is not for us
+            if update.effective_chat.type != 'private':
+                return
+            chord_names = text.split(',')
+            cls.reply_chords(update, chord_names)
+            return
+        cls.reply_chords(update, chord_names, checked=True)
+
+    @staticmethod
+    def builds(chord_name) -> bool:
+        try:
+            ChordParser.build(ChordParser.parse(chord_name))
+        except (IndexError, KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    @classmethod
+    def reply_chords(cls, update: Update, chord_names, checked=False) -> None:
+        """ checked: the names already passed the chord filter """
         user = update.effective_user.id
         tuning_name = ''
         tuning = cls.user_settings.get(user, {}).get('tuning')
         reverse = cls.user_settings.get(user, {}).get('reverse', False)
+        kapo = cls.user_settings.get(user, {}).get('kapo', 0)
+        frets = tuple(cls.user_settings.get(user, {}).get('frets', (0, 11)))
         if tuning is not None:
             tuning_name = ' (tuning: {})'.format(tuning.name)
-        print('tuning for {} is {}'.format(user, tuning))
+        logger.debug('tuning for %s is %s', user, tuning)
+        replies = list()
+        uploads = list()
         for chord_name in chord_names:
             chord_name = chord_name.strip()
+            if not checked and not cls.chord_filter.is_chord(chord_name):
+                replies.append(('message', '{} is not a valid chord name'.format(chord_name), dict()))
+                uploads.append(None)
+                continue
+            key = ChordIndex.key(chord_name, tuning, reverse, kapo, frets)
+            # an uploaded diagram is sent by file_id and never drawn again
+            file_id = cls.chord_index.get_photo(*key)
+            title = cls.chord_index.get_title(*key)
             try:
-                title, result = ChordParser.explain_draw(chord_name, tuning=tuning, reverse=reverse)
-            except (IndexError) as e:
-                print(e, chord_name)
-                result = '{} is not a valid chord name'.format(chord_name)
-                update.message.reply_text(result)
+                if file_id is None:
+                    title, jpeg = cls.draw(key, tuning=tuning)
+            except (IndexError, KeyError, TypeError, ValueError) as e:
+                logger.info('%s: %s', chord_name, e)
+                # the user's tuning or frets may be at fault, only the name itself is cached
+                if cls.builds(chord_name):
+                    result = '{} cannot be drawn with your settings'.format(chord_name)
+                else:
+                    cls.chord_filter.remember(chord_name)
+                    result = '{} is not a valid chord name'.format(chord_name)
+                replies.append(('message', result, dict()))
+                uploads.append(None)
             else:
-                update.message.reply_text(title + tuning_name)
-                bio = BytesIO()
-                bio.name = 'schema.jpeg'
-                result.save(bio, 'JPEG')
-                bio.seek(0)
-                update.message.reply_photo(bio)
+                cls.popularity.hit(key)
+                photo = cls.jpeg_file(jpeg) if file_id is None else file_id
+                replies.append(('photo', photo, dict(caption=title + tuning_name)))
+                uploads.append((key, title) if file_id is None else None)
 
+        for sent, upload in zip(cls.reply_all(update, replies), uploads):
+            if upload is not None:
+                sent.add_done_callback(lambda future, upload=upload: cls.uploaded(future, *upload))
 
-def main() -> None:
-    """Start the bot."""
-    updater = Updater(os.environ.get("bot_token"))
+    @classmethod
+    def uploaded(cls, future: Future, key, title) -> None:
+        """ remember file_id and title of a sent diagram """
+        if future.exception() is not None:
+            return
+        message = future.result()
+        if message and message.photo:
+            cls.chord_index.add_photo(key[0], message.photo[-1].file_id, *key[1:], title=title)
+
+    @classmethod
+    @noexceptions
+    def key(cls, update: Update, context: CallbackContext) -> None:
+        user = update.effective_user.id
+        if not len(context.args):
+            cls.reply_text(update, 'key cannot be empty, eg, "/key C major"')
+            return
+
+        tonic = ChordIndex.normalize(context.args[0])
+        mode = context.args[1] if len(context.args) > 1 else 'major'
+        try:
+            harmony = Harmony(tonic, mode)
+        except (ValueError, IndexError):
+            cls.reply_text(update, 'invalid key {}'.format(' '.join(context.args)))
+            return
+
+        tuning = cls.user_settings.get(user, {}).get('tuning')
+        reverse = cls.user_settings.get(user, {}).get('reverse', False)
+        kapo = cls.user_settings.get(user, {}).get('kapo', 0)
+        frets = tuple(cls.user_settings.get(user, {}).get('frets', (0, 11)))
+        cls.reply_text(update, '\n'.join(
+            [str(harmony), ''] + harmony.describe() + [''] + harmony.describe(sevenths=True)))
+        photos = list()
+        for sevenths in (False, True):
+            bio = BytesIO()
+            harmony.draw(sevenths=sevenths, tuning=tuning, reverse=reverse,
+                         kapo=kapo, start=frets[0], end=frets[1]).save(bio, 'JPEG')
+            caption = '{} {} {}'.format(harmony.tonic, harmony.name, 'sevenths' if sevenths else 'triads')
+            photos.append(('photo', cls.jpeg_file(bio.getvalue()), dict(caption=caption)))
+        cls.reply_all(update, photos)
+
+    @classmethod
+    def draw(cls, key, tuning=None):
+        """ title and jpeg of a diagram, the last MAX_RENDERED used ones are kept """
+        with cls.rendered_lock:
+            cached = cls.rendered.get(key)
+            if cached is not None:
+                cls.rendered.move_to_end(key)
+                return cached
+        chord_name, _, reverse, kapo, (start, end) = key
+        title, img = ChordParser.explain_draw(chord_name, tuning=tuning, reverse=reverse,
+                                              kapo=kapo, start=start, end=end)
+        bio = BytesIO()
+        img.save(bio, 'JPEG')
+        with cls.rendered_lock:
+            cls.rendered[key] = title, bio.getvalue()
+            cls.rendered.move_to_end(key)
+            while len(cls.rendered) > cls.MAX_RENDERED:
+                cls.rendered.popitem(last=False)
+            return cls.rendered[key]
+
+    @staticmethod
+    def jpeg_file(jpeg):
+        bio = BytesIO(jpeg)
+        bio.name = 'schema.jpeg'
+        return bio
+
+    @classmethod
+    @noexceptions
+    def prewarm(cls, context: CallbackContext) -> None:
+        """
+        Renders the most requested diagrams after a restart, one per job run
+        and only while no updates are waiting and no replies are queued. With
+        "cache_chat_id" set the diagrams are uploaded there too, through the
+        sender and one at a time, so users get them by file_id.
+        """
+        if cls.prewarm_queue is None:
+            cls.prewarm_queue = cls.popularity.load().top(cls.PREWARM_TOP)
+        if not cls.prewarm_queue and cls.prewarm_upload is None:
+            context.job.schedule_removal()
+            return
+        if context.dispatcher.update_queue.qsize() or cls.sender.pending():
+            return
+        if cls.prewarm_upload is not None or not cls.prewarm_queue:
+            return
+
+        key = cls.prewarm_queue.pop(0)
+        if cls.chord_index.get_photo(*key) is not None:
+            return
+        tuning_name = key[1]
+        tuning = None if tuning_name == Tuning.DEFAULT_TUNING_NAME else Tuning(name=tuning_name)
+        title, jpeg = cls.draw(key, tuning=tuning)
+        chat_id = os.environ.get("cache_chat_id")
+        if chat_id:
+            cls.prewarm_upload = cls.sender.send_photo(chat_id, cls.jpeg_file(jpeg), caption=title,
+                                                       disable_notification=True)
+            cls.prewarm_upload.add_done_callback(lambda future, key=key, title=title: cls.prewarmed(future, key, title))
+
+    @classmethod
+    def prewarmed(cls, future: Future, key, title) -> None:
+        """ keep the file_id, or try the upload again later """
+        cls.prewarm_upload = None
+        if future.exception() is None:
+            cls.uploaded(future, key, title)
+            return
+        attempts = cls.prewarm_attempts[key] = cls.prewarm_attempts.get(key, 0) + 1
+        logger.warning('prewarm upload of %s failed (%s): %s', key[0], attempts, future.exception())
+        if attempts < cls.PREWARM_ATTEMPTS:
+            cls.prewarm_queue.append(key)
+
+    @classmethod
+    @noexceptions
+    def flush_popularity(cls, context: CallbackContext) -> None:
+        cls.popularity.flush()
+
+    @classmethod
+    @noexceptions
+    def log_filter(cls, context: CallbackContext) -> None:
+        """ how much of the text traffic the chord filter lets through """
+        logger.info('chord filter: accepted %(accepted)d, rejected %(rejected)d, cache hits %(cache_hits)d',
+                    cls.chord_filter.counters)
+
+    @classmethod
+    @noexceptions
+    def inline(cls, update: Update, context: CallbackContext) -> None:
+        query = update.inline_query
+        user = update.effective_user.id
+        tuning = cls.user_settings.get(user, {}).get('tuning')
+        reverse = cls.user_settings.get(user, {}).get('reverse', False)
+        kapo = cls.user_settings.get(user, {}).get('kapo', 0)
+        frets = cls.user_settings.get(user, {}).get('frets', (0, 11))
+        results = [
+            InlineQueryResultCachedPhoto(id=str(n), photo_file_id=file_id, title=chord_name, caption=chord_name)
+            for n, (chord_name, file_id) in enumerate(
+                cls.chord_index.cached(query.query, tuning=tuning, reverse=reverse, kapo=kapo, frets=frets))
+        ]
+        # the typed chord if it has no diagram yet, else the first completion without one
+        chord_name = ChordIndex.normalize(query.query)
+        if not cls.chord_filter.is_chord(chord_name) or cls.chord_index.get_photo(
+                chord_name, tuning=tuning, reverse=reverse, kapo=kapo, frets=frets) is not None:
+            chord_name = cls.chord_index.suggest(query.query, tuning=tuning, reverse=reverse, kapo=kapo, frets=frets)
+        switch_pm_text = switch_pm_parameter = None
+        if chord_name is not None and query.query.strip():
+            switch_pm_text = 'Draw {} in private chat'.format(chord_name)[:64]
+            switch_pm_parameter = ChordIndex.start_parameter(chord_name)
+        query.answer(results, cache_time=5, is_personal=True,
+                     switch_pm_text=switch_pm_text, switch_pm_parameter=switch_pm_parameter)
+
+
+def create_updater(token, base_url=None, popularity_file=None, jobs=True) -> Updater:
+    """Create an updater with all bot handlers registered.
+
+    Request counts are loaded from and flushed to popularity_file, if given;
+    jobs=False leaves out prewarming and flushing.
+    """
+    updater = Updater(token, base_url=base_url,
+                      request_kwargs=dict(con_pool_size=Sender.WORKERS + 8))
     dispatcher = updater.dispatcher
+    Bot.sender = Sender(updater.bot).start()
+    Bot.popularity = Popularity(popularity_file)
+    Bot.prewarm_queue = None
 
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, Bot.explain))
 
-    dispatcher.add_handler(CommandHandler("start", Bot.help))
+    dispatcher.add_handler(CommandHandler("start", Bot.start))
     dispatcher.add_handler(CommandHandler("help", Bot.help))
     dispatcher.add_handler(CommandHandler("tune", Bot.tune))
     dispatcher.add_handler(CommandHandler("tuning", Bot.tune))
     dispatcher.add_handler(CommandHandler("reverse", Bot.reverse))
+    dispatcher.add_handler(CommandHandler("capo", Bot.capo))
+    dispatcher.add_handler(CommandHandler("frets", Bot.frets))
+    dispatcher.add_handler(CommandHandler("key", Bot.key))
+    dispatcher.add_handler(InlineQueryHandler(Bot.inline))
+
+    if jobs:
+        updater.job_queue.run_repeating(Bot.prewarm, interval=Bot.PREWARM_INTERVAL, first=1)
+        updater.job_queue.run_repeating(Bot.flush_popularity, interval=Bot.FLUSH_INTERVAL)
+        updater.job_queue.run_repeating(Bot.log_filter, interval=Bot.FLUSH_INTERVAL)
+    return updater
+
 
+def main() -> None:
+    """Start the bot."""
+    listener = setup_logging(os.environ.get("log_level", "WARNING"))
+    updater = create_updater(os.environ.get("bot_token"), base_url=os.environ.get("bot_api_url"),
+                             popularity_file=os.environ.get("popularity_file", "popularity.json"))
     updater.start_polling()
     updater.idle()
+    Bot.sender.stop()
+    Bot.popularity.flush()
+    listener.stop()
 
 
 if __name__ == '__main__':
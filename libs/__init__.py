@@ -1 +1,7 @@
+from .trace import *
 from .chord import *
+from .inline import *
+from .prefilter import *
+from .popularity import *
+from .harmony import *
+from .sender import *
@@ -1,4 +1,6 @@
 from PIL import Image, ImageDraw, ImageFont
+from .trace import Trace
+import functools
 import re
 
 
@@ -145,9 +147,10 @@ class Tuning:
 
     DEFAULT_OCTAVE_ORDER = 2, 1, 1, 1, 0
     DEFAULT_TUNING_NAME = 'EBGDAE'
+    MAX_STRINGS = 12
 
     def __init__(self, name=DEFAULT_TUNING_NAME, octave_order=DEFAULT_OCTAVE_ORDER):
-        if not re.match(r'^[ABCDEFGH#b]+$', name):
+        if len(name) > 2 * self.MAX_STRINGS or not re.match(r'^[ABCDEFGH#b]+$', name):
             raise ValueError('bad tune')
         self.name = name
         self.octave_order = octave_order
@@ -157,6 +160,8 @@ class Tuning:
                 self.strings[len(self.strings) - 1] += 1
             else:
                 self.add_string(string)
+        if len(self.strings) > self.MAX_STRINGS:
+            raise ValueError('more than {} strings'.format(self.MAX_STRINGS))
 
     def get_string_octave(self, n):
         if len(self.octave_order) <= n:
@@ -187,6 +192,9 @@ class Tuning:
 
 class Fretboard:
 
+    # note names of the whole neck are kept for this many (strings, frets)
+    MAX_LAYOUTS = 64
+
     def __init__(self, tuning=None, frets=22):
         self.frets = frets
         self.allow_bass = True
@@ -213,7 +221,7 @@ class Fretboard:
             nearest_notes = list()
             for i in range(-24, 24, 12):
                 nearest_notes += [note + i - n for note in major_steps
-                                  if note + i - n >= 0]
+                                  if note + i - n >= kapo]
 
             for nearest_note in nearest_notes:
                 chord_pos.append((k + 1, nearest_note))
@@ -265,7 +273,7 @@ class Fretboard:
 
     def find_note(self, note, exact=False, frets=22, kapo=0):
         for string, n in enumerate(self.tuning):
-            i = 0
+            i = kapo
             if exact:
                 if frets >= note - n >= kapo:
                     yield string + 1, note - n
@@ -304,18 +312,39 @@ class Fretboard:
             string.append('{}'.format(i).rjust(4))
         print(' '.join(string))
 
-    def get_schema(self, notes, as_string=True, start=0, end=11):
+    @property
+    def layout(self):
+        """ (major key, minor key) for every fret of every string, lowest string first """
+        return self.build_layout(tuple((n.key, n.octave) for n in self.tuning), self.frets)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=MAX_LAYOUTS)
+    def build_layout(strings, frets):
+        """ strings are (key, octave) of a tuning """
+        return tuple(
+            tuple(((n + i).major_key, (n + i).minor_key) for i in range(frets + 1))
+            for n in (Note(key, octave=octave) for key, octave in reversed(strings))
+        )
+
+    def window(self, start=0, end=11, kapo=0):
+        """ absolute frets of a window counted from the capo, cut at the end of the neck """
+        first = min(kapo + start, self.frets)
+        last = min(kapo + end, self.frets)
+        return first, last
+
+    def get_schema(self, notes, as_string=True, start=0, end=11, kapo=0):
+        """ frets start..end are counted from the capo """
         schema = list()
         steps = {v.key: k for k, v in notes.notes.items()}
+        first, last = self.window(start, end, kapo)
         # notes
-        for n in reversed(list(self.tuning)):
+        for string_keys in self.layout:
             string = list()
-            for i in range(start, end + 1):
-
-                if (n + i).major_key in steps:
-                    symb = steps[(n + i).major_key]
-                elif (n + i).minor_key in steps:
-                    symb = steps[(n + i).minor_key]
+            for major_key, minor_key in string_keys[first:last + 1]:
+                if major_key in steps:
+                    symb = steps[major_key]
+                elif minor_key in steps:
+                    symb = steps[minor_key]
                 else:
                     symb = ' '
                 if symb == 1:
@@ -323,9 +352,9 @@ class Fretboard:
                 string.append(' {}'.format(symb).rjust(3))
             schema.append('|'.join(string))
         # frets
-        schema.append(' ' * (4 * (end - start + 1) - 1))
+        schema.append(' ' * (4 * (last - first + 1) - 1))
         string = list()
-        for i in range(start, end + 1):
+        for i in range(first - kapo, last - kapo + 1):
             string.append('{}'.format(i).rjust(3))
         schema.append(' '.join(string))
         if as_string:
@@ -365,12 +394,15 @@ class ChordBuilder:
 
     NATURAL_MAJOR_STEPS = 'CDEFGAB'
 
-    def __init__(self, tonic: Note):
+    def __init__(self, tonic: Note, trace=None):
         assert isinstance(tonic, Note)
         self.steps = dict()
         self.steps[1] = tonic
         self.is_minor = False
-        print(' 1 {} tonic'.format(self.tonic))
+        # construction steps, only while tracing
+        self.trace = trace
+        if trace is not None:
+            trace.step('tonic', 1, self.tonic)
 
     @property
     def tonic(self):
@@ -387,21 +419,26 @@ class ChordBuilder:
         interval = self.step_interval(step)
         self.steps[step] = self.tonic + interval
         self.steps[step].set_gamma(self.tonic.gamma)
-        print(' {} {} added'.format(step, self.steps[step]))
+        if self.trace is not None:
+            self.trace.step('added', step, self.steps[step])
 
     def enlarge(self, step):
         if self.steps.get(step) is None:
-            print('no step {} to enlarge'.format(step))
+            if self.trace is not None:
+                self.trace.step('missing', step, detail='enlarge')
             return
-        print('♯{} {} enlarged'.format(step, self.steps[step]))
+        if self.trace is not None:
+            self.trace.step('enlarged', step, self.steps[step])
         self.steps[step] += 1
         self.steps[step].set_gamma(Note.MAJOR)
 
     def reduce(self, step):
         if self.steps.get(step) is None:
-            print('no step {} to reduce'.format(step))
+            if self.trace is not None:
+                self.trace.step('missing', step, detail='reduce')
             return
-        print('♭{} {} reduced'.format(step, self.steps[step]))
+        if self.trace is not None:
+            self.trace.step('reduced', step, self.steps[step])
         self.steps[step] -= 1
         self.steps[step].set_gamma(Note.MINOR)
 
@@ -444,7 +481,8 @@ class ChordBuilder:
             r"sus[249]"
             as last
         """
-        print(' {} {} suspended to {}'.format(base,  self.steps[base], target))
+        if self.trace is not None:
+            self.trace.step('suspended', base, self.steps.get(base), detail=target)
         if base in self.steps:
             del self.steps[base]
 
@@ -480,7 +518,8 @@ class ChordBuilder:
         self.steps[i] = Note(key, octave=self.tonic.octave-1)
 
     def omit(self, step):
-        print(' {} {} omitted'.format(step, self.steps[step]))
+        if self.trace is not None:
+            self.trace.step('omitted', step, self.steps.get(step))
         if self.steps.get(step) is not None:
             del self.steps[step]
 
@@ -528,25 +567,29 @@ class ChordParser:
     BASE_PATTERS = re.compile(r"^([A-H][b#]?)(sus(?!\d)|m(?!aj)|maj(?!\d)||[+-])(dim|aug|)")
     ALTERATIONS_PATTERN = re.compile(r"((?:[#b+-/]|add|sus|no|omit|maj|))(\d+)")
     BASS_PATTERN = re.compile(r"/([A-H][b#+-]?)")
+    TO_REPLACE = {
+        'H': 'B',
+        'Ø': 'm7b5',
+        '°7': 'dim7',
+        '°': 'dim7',
+        'o7': 'dim7',
+        'Δ7': 'maj7',
+        'Δ': 'maj7',
+        'M': 'maj',
+    }
+    FONT = None
 
     @classmethod
     def parse(cls, chord):
-        print(chord)
-        to_replace = {
-            'H': 'B',
-            'Ø': 'm7b5',
-            '°7': 'dim7',
-            '°': 'dim7',
-            'o7': 'dim7',
-            'Δ7': 'maj7',
-            'Δ': 'maj7',
-            'M': 'maj',
-        }
-        for pattern, replace in to_replace.items():
+        trace = Trace.start()
+        if trace is not None:
+            trace.step('input', detail=chord)
+        for pattern, replace in cls.TO_REPLACE.items():
             if pattern in chord:
                 prev = chord
                 chord = chord.replace(pattern, replace)
-                print('Pattern "{}": Replaced {} to {}'.format(pattern, prev, chord))
+                if trace is not None:
+                    trace.step('replaced', detail=(pattern, prev, chord))
         is_bms = chord.endswith('+')
         if is_bms:
             chord = chord[:-1]
@@ -565,7 +608,8 @@ class ChordParser:
             modifier=main[3],
             alterations=alterations,
             bass_to_add=add_bass,
-            is_bms=is_bms
+            is_bms=is_bms,
+            trace=trace
         )
 
     @staticmethod
@@ -580,7 +624,7 @@ class ChordParser:
         """
         # set tonic
         tonic = data['tonic']
-        chord = ChordBuilder(Note(tonic))
+        chord = ChordBuilder(Note(tonic), trace=data.get('trace'))
         # set character
         character = data['character']
         major = 'maj', ''
@@ -642,20 +686,29 @@ class ChordParser:
         # add bass
         for note in data['bass_to_add']:
             chord.add_bass(note)
+        if chord.trace is not None:
+            chord.trace.step('result', detail=str(chord))
+            chord.trace.emit()
         return chord
 
     @classmethod
     def chord(cls, chord_name):
         chord_data = cls.parse(chord_name)
         chord_obj = cls.build(chord_data)
-        print('→', chord_obj)
         return chord_obj
 
+    @classmethod
+    def font(cls):
+        if cls.FONT is None:
+            cls.FONT = ImageFont.truetype("assets/source.ttf", size=16)
+        return cls.FONT
+
     @staticmethod
     def draw_text(lines):
-        width = 512
+        font = ChordParser.font()
+        # cropped to the text, a narrow fret window gives a narrow image
+        width = int(max(font.getlength(line) for line in lines)) + 32
         height = len(lines) * 16 + 32
-        font = ImageFont.truetype("assets/source.ttf", size=16)
         img = Image.new('RGB', (width, height), color='#f0f0e0')
         imgDraw = ImageDraw.Draw(img)
         for n, line in enumerate(lines):
@@ -672,12 +725,15 @@ class ChordParser:
         return title, schema
 
     @classmethod
-    def explain_draw(cls, chord_name, tuning=None, reverse=False):
+    def explain_draw(cls, chord_name, tuning=None, reverse=False, kapo=0, start=0, end=11):
         chord_parsed = cls.parse(chord_name)
         chord = cls.build(chord_parsed)
         title = '{}: {}'.format(chord_name, chord)
         fretboard = Fretboard(tuning=tuning)
-        schema = fretboard.get_schema(chord, as_string=False)
+        schema = fretboard.get_schema(chord, as_string=False, start=start, end=end, kapo=kapo)
+
+        if kapo:
+            title += ' (capo {})'.format(kapo)
 
         if reverse:
             title += ' (fret is mirrored)'
@@ -0,0 +1,421 @@
+"""
+Local stand-in for the Telegram Bot API and a load-replay driver.
+
+    python -m libs.fakeapi [--rate 20] [--count 200] [--latency 0.05] [--rate-limit 0.01] [updates.jsonl]
+
+The replay feeds recorded (json lines with Telegram updates, or plain text
+lines) or synthetic update streams to the real bot handlers and reports
+end-to-end latency, throughput and error counts.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.parser import BytesParser
+import itertools
+import argparse
+import threading
+import logging
+import math
+import random
+import runpy
+import json
+import time
+import os
+
+from .trace import setup_logging
+
+
+SYNTHETIC_CHORDS = (
+    'Am', 'C', 'G', 'E7', 'Dm', 'F', 'Am7', 'Dsus4/B', 'Cmaj7', 'Bm7b5',
+    'A5', 'Gadd9', 'Em, Am, D7', 'F#m', 'Bb', 'Ebdim7', 'Caug', 'Hm',
+)
+
+
+class FakeBotApi:
+    """
+    Threaded HTTP server speaking the subset of the Bot API the bot uses.
+    Updates are queued with `push`; everything sent back is recorded in `sent`
+    as (timestamp, method, chat_id, payload), non-2xx answers are counted in `errors`
+    per (method, status).
+    """
+
+    SEND_METHODS = 'sendMessage', 'sendPhoto', 'sendMediaGroup', 'answerInlineQuery'
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, rate_limit=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.updates = list()
+        self.sent = list()
+        self.rate_limited = 0
+        self.calls = dict()
+        self.errors = dict()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._random = random.Random(0)
+        # own stream, so the share of 429s does not depend on latency and jitter draws
+        self._limits = random.Random(1)
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/bot'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push(self, update):
+        """ queue an update, returns its update_id """
+        with self._cond:
+            update = dict(update, update_id=next(self._update_ids))
+            self.updates.append(update)
+            self._cond.notify_all()
+        return update['update_id']
+
+    def get_updates(self, offset=0, limit=100, timeout=0):
+        deadline = time.monotonic() + float(timeout)
+        with self._cond:
+            # confirmed updates are dropped as the real API does
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    def sleep(self):
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def is_rate_limited(self):
+        with self._cond:
+            limited = self._limits.random() < self.rate_limit
+            if limited:
+                self.rate_limited += 1
+        return limited
+
+    def message(self, chat_id, **kwargs):
+        return dict(
+            message_id=next(self._message_ids),
+            date=int(time.time()),
+            chat=dict(id=chat_id, type='private'),
+            **kwargs
+        )
+
+    def photo(self, chat_id):
+        message_id = next(self._message_ids)
+        return dict(
+            message_id=message_id,
+            date=int(time.time()),
+            chat=dict(id=chat_id, type='private'),
+            photo=[dict(file_id='fake-photo-{}'.format(message_id),
+                        file_unique_id='fake-unique-{}'.format(message_id),
+                        width=512, height=256)],
+        )
+
+    def call(self, method, params):
+        """ returns (http status, api response) """
+        with self._cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        status, response = self.answer(method, params)
+        if not 200 <= status <= 299:
+            with self._cond:
+                self.errors[method, status] = self.errors.get((method, status), 0) + 1
+        return status, response
+
+    def answer(self, method, params):
+        if method == 'getUpdates':
+            result = self.get_updates(
+                offset=int(params.get('offset') or 0),
+                limit=int(params.get('limit') or 100),
+                timeout=float(params.get('timeout') or 0),
+            )
+            return 200, dict(ok=True, result=result)
+        if method == 'getMe':
+            return 200, dict(ok=True, result=dict(id=1, is_bot=True, first_name='finga', username='finga_bot'))
+        if method in ('deleteWebhook', 'setWebhook'):
+            return 200, dict(ok=True, result=True)
+
+        if method not in self.SEND_METHODS:
+            return 404, dict(ok=False, error_code=404, description='Not Found: method {}'.format(method))
+
+        self.sleep()
+        if self.is_rate_limited():
+            return 429, dict(
+                ok=False,
+                error_code=429,
+                description='Too Many Requests: retry after {}'.format(self.retry_after),
+                parameters=dict(retry_after=self.retry_after),
+            )
+
+        chat_id = params.get('chat_id')
+        chat_id = int(chat_id) if chat_id is not None else None
+        if method == 'sendMessage':
+            result = self.message(chat_id, text=params.get('text', ''))
+        elif method == 'sendPhoto':
+            result = self.photo(chat_id)
+        elif method == 'sendMediaGroup':
+            result = [self.photo(chat_id) for _ in json.loads(params.get('media', '[]'))]
+        else:
+            result = True
+        with self._cond:
+            self.sent.append((time.monotonic(), method, chat_id, params))
+        return 200, dict(ok=True, result=result)
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                status, response = api.call(method, self.parse(body))
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def parse(self, body):
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/form-data'):
+                    head = 'Content-Type: {}\r\n\r\n'.format(content_type).encode('utf-8')
+                    message = BytesParser().parsebytes(head + body)
+                    params = dict()
+                    for part in message.get_payload():
+                        name = part.get_param('name', header='content-disposition')
+                        if part.get_filename() is None:
+                            params[name] = part.get_payload(decode=True).decode('utf-8')
+                        else:
+                            params[name] = part.get_payload(decode=True)
+                    return params
+                if body:
+                    return json.loads(body.decode('utf-8'))
+                return dict()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class ErrorCounter(logging.Handler):
+    """ counts error records, e.g. handler exceptions swallowed by the bot """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class Replay:
+    """
+    Feeds update streams into a FakeBotApi at a fixed rate.
+    Every update gets its own chat, so a reply is matched to its update by chat_id;
+    users are drawn from a small pool to keep per-user settings in play.
+    An update is answered when all the replies it should get have arrived.
+    """
+
+    CHAT_ID_BASE = 10 ** 9
+
+    def __init__(self, api, rate=10.0, users=10):
+        self.api = api
+        self.rate = rate
+        self.users = users
+        self.injected = dict()
+        self.expected = dict()
+        self.handler_errors = ErrorCounter()
+
+    @staticmethod
+    def load(path):
+        """ read recorded updates (json lines) or plain message texts """
+        texts = list()
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    update = json.loads(line)
+                except ValueError:
+                    texts.append(line)
+                    continue
+                message = update.get('message') if isinstance(update, dict) else None
+                if message and message.get('text'):
+                    texts.append(message['text'])
+        return texts
+
+    @staticmethod
+    def synthetic(count, seed=0):
+        rnd = random.Random(seed)
+        return [rnd.choice(SYNTHETIC_CHORDS) for _ in range(count)]
+
+    @staticmethod
+    def expected_replies(text):
+        """ one reply per chord or command, /key sends its chords and two diagrams """
+        if text.startswith('/key'):
+            return 3
+        if text.startswith('/'):
+            return 1
+        return len(text.split(','))
+
+    def update(self, n, text):
+        chat_id = self.CHAT_ID_BASE + n
+        user_id = n % self.users + 1
+        message = dict(
+            message_id=n + 1,
+            date=int(time.time()),
+            chat=dict(id=chat_id, type='private'),
+            text=text,
+            **{'from': dict(id=user_id, is_bot=False, first_name='user{}'.format(user_id))}
+        )
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [dict(type='bot_command', offset=0, length=len(command))]
+        return dict(message=message)
+
+    def run(self, texts, settle=2.0, timeout=60.0):
+        """ inject all texts, then wait until the bot goes quiet """
+        logging.getLogger().addHandler(self.handler_errors)
+        start = time.monotonic()
+        interval = 1.0 / self.rate if self.rate else 0
+        for n, text in enumerate(texts):
+            delay = start + n * interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.injected[self.CHAT_ID_BASE + n] = time.monotonic()
+            self.expected[self.CHAT_ID_BASE + n] = self.expected_replies(text)
+            self.api.push(self.update(n, text))
+
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                last = self.api.sent[-1][0] if self.api.sent else start
+                received, _ = self.received()
+                if time.monotonic() - last > settle and len(self.answered(received)) == len(self.injected):
+                    break
+                if time.monotonic() - last > settle * 5:
+                    break
+                time.sleep(0.05)
+        finally:
+            logging.getLogger().removeHandler(self.handler_errors)
+        return self.report(start)
+
+    def received(self):
+        """ replies per chat and the time of the last one """
+        received = dict()
+        last = dict()
+        for ts, method, chat_id, params in list(self.api.sent):
+            if chat_id not in self.injected:
+                continue
+            replies = len(json.loads(params.get('media', '[]'))) if method == 'sendMediaGroup' else 1
+            received[chat_id] = received.get(chat_id, 0) + replies
+            last[chat_id] = max(ts, last.get(chat_id, ts))
+        return received, last
+
+    def answered(self, received):
+        return [c for c, n in received.items() if n >= self.expected[c]]
+
+    def report(self, start):
+        received, last = self.received()
+        answered = self.answered(received)
+        latencies = sorted(last[c] - self.injected[c] for c in answered)
+        end = max(last[c] for c in answered) if answered else time.monotonic()
+        return dict(
+            updates=len(self.injected),
+            answered=len(answered),
+            partial=len(received) - len(answered),
+            unanswered=len(self.injected) - len(received),
+            replies_expected=sum(self.expected.values()),
+            replies_received=sum(min(n, self.expected[c]) for c, n in received.items()),
+            handler_errors=self.handler_errors.count,
+            rate_limited=self.api.rate_limited,
+            api_errors=dict(('{} {}'.format(*k), v) for k, v in sorted(self.api.errors.items())),
+            sends=len(self.api.sent),
+            p50=percentile(latencies, 50),
+            p99=percentile(latencies, 99),
+            throughput=len(answered) / max(end - start, 1e-9),
+        )
+
+
+def percentile(values, p):
+    """ nearest-rank percentile of a sorted list """
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+def format_report(report):
+    def ms(value):
+        return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+    errors = ', '.join('{}: {}'.format(k, v) for k, v in report['api_errors'].items()) or 'none'
+    text = (
+        'updates: {updates}, answered: {answered}, partial: {partial}, unanswered: {unanswered}\n'
+        'replies: {replies_received}/{replies_expected}, sends: {sends}, '
+        'handler errors: {handler_errors}, rate limited: {rate_limited}, api errors: {errors}\n'
+        'p50: {p50}, p99: {p99}, throughput: {throughput:.2f} updates/s'
+    ).format(**dict(report, errors=errors, p50=ms(report['p50']), p99=ms(report['p99'])))
+    if 'chord_filter' in report:
+        text += '\nchord filter: accepted {accepted}, rejected {rejected}, cache hits {cache_hits}'.format(
+            **report['chord_filter'])
+    return text
+
+
+def load_bot():
+    """ the real handlers live in the root __main__.py """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return runpy.run_path(os.path.join(root, '__main__.py'), run_name='finga_bot')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay updates against a local fake Bot API.')
+    parser.add_argument('source', nargs='?', help='recorded updates (json lines) or message texts')
+    parser.add_argument('--count', type=int, default=100, help='synthetic updates if no source given')
+    parser.add_argument('--rate', type=float, default=10.0, help='updates per second')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every send')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='share of sends answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    listener = setup_logging(args.log_level)
+
+    api = FakeBotApi(latency=args.latency, jitter=args.jitter,
+                     rate_limit=args.rate_limit, retry_after=args.retry_after).start()
+    texts = Replay.load(args.source) if args.source else Replay.synthetic(args.count)
+    bot = load_bot()
+    # no prewarming and no popularity file, the production counts stay untouched
+    updater = bot['create_updater']('123456:fake', base_url=api.base_url, jobs=False)
+    updater.start_polling(poll_interval=0, timeout=1)
+    try:
+        report = Replay(api, rate=args.rate, users=args.users).run(texts)
+        report['chord_filter'] = bot['Bot'].chord_filter.counters
+    finally:
+        updater.stop()
+        bot['Bot'].sender.stop()
+        api.stop()
+        listener.stop()
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
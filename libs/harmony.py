@@ -0,0 +1,125 @@
+from .chord import Note, ChordBuilder, ChordParser, Fretboard
+
+
+class Harmony:
+    """
+    Diatonic triads and sevenths of a key.
+    Every degree is read from one scale table computed at import, so a key
+    costs no parsing and all seven diagrams are drawn in one pass.
+    """
+
+    MODES = {
+        'ionian': (0, 2, 4, 5, 7, 9, 11),
+        'dorian': (0, 2, 3, 5, 7, 9, 10),
+        'phrygian': (0, 1, 3, 5, 7, 8, 10),
+        'lydian': (0, 2, 4, 6, 7, 9, 11),
+        'mixolydian': (0, 2, 4, 5, 7, 9, 10),
+        'aeolian': (0, 2, 3, 5, 7, 8, 10),
+        'locrian': (0, 1, 3, 5, 6, 8, 10),
+    }
+    ALIASES = {'major': 'ionian', 'minor': 'aeolian'}
+    # degree of the relative major for every mode, used to pick sharps or flats
+    PARENT_DEGREE = {'ionian': 0, 'dorian': 1, 'phrygian': 2, 'lydian': 3, 'mixolydian': 4, 'aeolian': 5, 'locrian': 6}
+    FLAT_KEYS = 'F', 'Bb', 'Eb', 'Ab', 'Db', 'Gb'
+    NUMERALS = 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII'
+
+    # (third, fifth) -> chord suffix, roman numeral is lower case, numeral mark
+    TRIADS = {
+        (4, 7): ('', False, ''),
+        (3, 7): ('m', True, ''),
+        (3, 6): ('dim', True, '°'),
+        (4, 8): ('aug', False, '+'),
+    }
+    # (third, fifth, seventh) -> chord suffix, roman numeral is lower case, numeral mark
+    SEVENTHS = {
+        (4, 7, 11): ('maj7', False, 'maj7'),
+        (4, 7, 10): ('7', False, '7'),
+        (3, 7, 10): ('m7', True, '7'),
+        (3, 7, 11): ('mmaj7', True, 'maj7'),
+        (3, 6, 10): ('m7b5', True, 'ø7'),
+        (3, 6, 9): ('dim7', True, '°7'),
+        (4, 8, 11): ('maj7#5', False, '+maj7'),
+    }
+
+    # mode -> degree -> (semitones from tonic, triad, seventh)
+    # where triad and seventh are (suffix, roman numeral)
+    TABLE = dict()
+
+    def __init__(self, tonic, mode='major'):
+        # name as asked for, mode is the canonical one
+        self.name = mode.lower()
+        mode = self.ALIASES.get(self.name, self.name)
+        if mode not in self.MODES:
+            raise ValueError('unknown mode {}'.format(mode))
+        tonic = Note(tonic)
+        if tonic.key not in Note.MAJOR and tonic.key not in Note.MINOR:
+            raise ValueError('unknown tonic {}'.format(tonic.key))
+        self.mode = mode
+        if '#' in tonic.key:
+            flats = False
+        elif 'b' in tonic.key:
+            flats = True
+        else:
+            # natural tonics follow the signature of their relative major
+            parent = tonic - self.MODES['ionian'][self.PARENT_DEGREE[mode]]
+            flats = parent.minor_key in self.FLAT_KEYS
+        self.scale = list()
+        for offset, _, _ in self.TABLE[mode]:
+            note = tonic + offset
+            self.scale.append(note.minor_key if flats else note.major_key)
+        self.tonic = self.scale[0]
+
+    @classmethod
+    def build_table(cls):
+        for mode, scale in cls.MODES.items():
+            degrees = list()
+            for d in range(7):
+                intervals = [(scale[(d + i) % 7] - scale[d]) % 12 for i in (2, 4, 6)]
+                triad = cls.TRIADS[tuple(intervals[:2])]
+                seventh = cls.SEVENTHS[tuple(intervals)]
+                degrees.append((scale[d], cls.label(d, triad), cls.label(d, seventh)))
+            cls.TABLE[mode] = tuple(degrees)
+
+    @classmethod
+    def label(cls, degree, quality):
+        suffix, lower, mark = quality
+        numeral = cls.NUMERALS[degree]
+        if lower:
+            numeral = numeral.lower()
+        return suffix, numeral + mark
+
+    def chords(self, sevenths=False):
+        """ (roman numeral, chord name, note names, ChordBuilder) for every degree """
+        result = list()
+        for d, (_, triad, seventh) in enumerate(self.TABLE[self.mode]):
+            suffix, numeral = seventh if sevenths else triad
+            names = [self.scale[(d + i) % 7] for i in ((0, 2, 4, 6) if sevenths else (0, 2, 4))]
+            chord = ChordBuilder(Note(names[0]))
+            for step, name in zip((3, 5, 7), names[1:]):
+                chord.steps[step] = Note(name)
+            chord.is_minor = numeral[0].islower()
+            result.append((numeral, names[0] + suffix, names, chord))
+        return result
+
+    def __str__(self):
+        return '{} {}: {}'.format(self.tonic, self.name, ' '.join(self.scale))
+
+    def describe(self, sevenths=False):
+        return ['{} {}: {}'.format(numeral, name, ' '.join(names))
+                for numeral, name, names, _ in self.chords(sevenths)]
+
+    def draw(self, sevenths=False, tuning=None, reverse=False, kapo=0, start=0, end=11):
+        """ every degree of the key on one image """
+        fretboard = Fretboard(tuning=tuning)
+        lines = list()
+        for numeral, name, names, chord in self.chords(sevenths):
+            schema = fretboard.get_schema(chord, as_string=False, start=start, end=end, kapo=kapo)
+            if not reverse:
+                schema = schema[::-1]
+            lines.append('{} {}: {}'.format(numeral, name, ' '.join(names)))
+            lines += schema
+            lines.append('')
+        return ChordParser.draw_text(lines[:-1])
+
+
+Harmony.build_table()
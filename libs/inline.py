@@ -0,0 +1,138 @@
+from bisect import bisect_left
+import threading
+import base64
+from .chord import ChordParser, Tuning
+
+
+class ChordIndex:
+    """
+    Sorted index over the chord vocabulary for inline autocomplete.
+    Holds uploaded diagram file_ids per (chord, tuning, reverse, capo, frets), so an inline
+    query is answered by a prefix lookup only, nothing is rendered on the keystroke path.
+    Chords without a diagram yet are offered to be drawn in private chat, see `start_parameter`.
+    Photos are added from the sender threads while queries are answered on the dispatcher,
+    so both go through one lock.
+    """
+
+    START_PREFIX = 'chord_'
+
+    TONICS = 'C', 'C#', 'Db', 'D', 'D#', 'Eb', 'E', 'F', 'F#', 'Gb', 'G', 'G#', 'Ab', 'A', 'A#', 'Bb', 'B'
+    SUFFIXES = (
+        '', 'm', '5', '6', 'm6', '7', 'm7', 'maj7', 'mmaj7', '9', 'm9', 'maj9', '11', '13',
+        'sus2', 'sus4', '7sus4', 'add9', 'madd9', 'dim', 'dim7', 'm7b5', 'aug', '7b9', '7#9', '7#5',
+    )
+
+    def __init__(self, names=None):
+        if names is None:
+            names = self.vocabulary()
+        self.names = sorted(set(names))
+        self.file_ids = dict()
+        # key -> diagram title, so a cached diagram is sent without drawing it
+        self.titles = dict()
+        # (tuning, reverse) -> sorted names with an uploaded diagram
+        self.uploaded = dict()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def vocabulary(cls):
+        """ tonic and suffix combinations the parser can build """
+        names = list()
+        for tonic in cls.TONICS:
+            for suffix in cls.SUFFIXES:
+                name = tonic + suffix
+                try:
+                    ChordParser.build(ChordParser.parse(name))
+                except (IndexError, KeyError, TypeError, ValueError):
+                    continue
+                names.append(name)
+        return names
+
+    @classmethod
+    def start_parameter(cls, name):
+        """ /start deep link parameter for a chord, only [A-Za-z0-9_-] are allowed there """
+        encoded = base64.urlsafe_b64encode(name.encode('utf-8')).decode('ascii').rstrip('=')
+        return (cls.START_PREFIX + encoded)[:64]
+
+    @classmethod
+    def from_start_parameter(cls, parameter):
+        """ chord name of a deep link parameter, None if it is not one """
+        if not parameter.startswith(cls.START_PREFIX):
+            return None
+        encoded = parameter[len(cls.START_PREFIX):]
+        try:
+            return base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).decode('utf-8')
+        except ValueError:
+            return None
+
+    @staticmethod
+    def normalize(query):
+        query = query.strip()
+        if not query:
+            return query
+        query = query[0].upper() + query[1:]
+        if query[0] == 'H':
+            query = 'B' + query[1:]
+        return query
+
+    @staticmethod
+    def key(name, tuning=None, reverse=False, kapo=0, frets=(0, 11)):
+        """ tuning is a Tuning or its name """
+        if tuning is None:
+            tuning = Tuning.DEFAULT_TUNING_NAME
+        elif isinstance(tuning, Tuning):
+            tuning = tuning.name
+        return name, tuning, bool(reverse), kapo, tuple(frets)
+
+    @staticmethod
+    def _insert(names, name):
+        i = bisect_left(names, name)
+        if i == len(names) or names[i] != name:
+            names.insert(i, name)
+
+    @staticmethod
+    def _prefixed(names, prefix, limit):
+        i = bisect_left(names, prefix)
+        result = list()
+        while i < len(names) and names[i].startswith(prefix) and len(result) < limit:
+            result.append(names[i])
+            i += 1
+        return result
+
+    def complete(self, prefix, limit=50):
+        with self._lock:
+            return self._prefixed(self.names, self.normalize(prefix), limit)
+
+    def add_photo(self, name, file_id, tuning=None, reverse=False, kapo=0, frets=(0, 11), title=None):
+        key = self.key(name.strip(), tuning, reverse, kapo, frets)
+        with self._lock:
+            # file_id first, a name in `uploaded` always has one
+            self.file_ids[key] = file_id
+            self.titles[key] = key[0] if title is None else title
+            self._insert(self.names, key[0])
+            self._insert(self.uploaded.setdefault(key[1:], list()), key[0])
+
+    def get_photo(self, name, tuning=None, reverse=False, kapo=0, frets=(0, 11)):
+        with self._lock:
+            return self.file_ids.get(self.key(name, tuning, reverse, kapo, frets))
+
+    def get_title(self, name, tuning=None, reverse=False, kapo=0, frets=(0, 11)):
+        with self._lock:
+            return self.titles.get(self.key(name, tuning, reverse, kapo, frets))
+
+    def cached(self, prefix, tuning=None, reverse=False, kapo=0, frets=(0, 11), limit=50):
+        """ (name, file_id) of already uploaded diagrams matching the prefix """
+        settings = self.key('', tuning, reverse, kapo, frets)[1:]
+        with self._lock:
+            names = self.uploaded.get(settings)
+            if not names:
+                return []
+            return [(name, self.file_ids[(name, ) + settings])
+                    for name in self._prefixed(names, self.normalize(prefix), limit)]
+
+    def suggest(self, prefix, tuning=None, reverse=False, kapo=0, frets=(0, 11), limit=50):
+        """ first chord of the vocabulary matching the prefix that has no diagram yet """
+        with self._lock:
+            for name in self.complete(prefix, limit):
+                if self.get_photo(name, tuning, reverse, kapo, frets) is None:
+                    return name
+        return None
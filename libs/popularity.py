@@ -0,0 +1,58 @@
+from collections import Counter
+import threading
+import logging
+import json
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class Popularity:
+    """
+    Request counts per (chord, tuning, reverse, capo, frets) key, see ChordIndex.key.
+    Kept on disk as a compact json list of [count, chord, tuning, reverse, capo, start, end],
+    written only when something changed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.counts = Counter()
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def hit(self, key):
+        with self._lock:
+            self.counts[key] += 1
+            self.dirty = True
+
+    def top(self, n):
+        with self._lock:
+            return [key for key, _ in self.counts.most_common(n)]
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                rows = json.load(f)
+        except ValueError as e:
+            logger.warning('bad popularity file %s: %s', self.path, e)
+            return self
+
+        with self._lock:
+            for count, name, tuning, reverse, kapo, start, end in rows:
+                self.counts[name, tuning, bool(reverse), kapo, (start, end)] += count
+        return self
+
+    def flush(self):
+        if not self.path or not self.dirty:
+            return
+        with self._lock:
+            rows = [[count, name, tuning, int(reverse), kapo, start, end]
+                    for (name, tuning, reverse, kapo, (start, end)), count in self.counts.most_common()]
+            self.dirty = False
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp, self.path)
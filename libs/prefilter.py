@@ -0,0 +1,73 @@
+import re
+
+
+class ChordFilter:
+    """
+    Cheap gate in front of ChordParser: decides whether a message is a chord list
+    before anything is parsed, built or drawn.
+
+    The pattern is ChordParser's grammar anchored on both ends, so ordinary
+    conversation is rejected after a couple of characters:
+        tonic [Ø ° o7 Δ M] [sus m min maj + -] [dim aug] (alteration)* [/bass] [+]
+    Alteration numbers take all their digits (at most two), so a run of digits splits
+    in one way only and a match never backtracks exponentially.
+    Names that passed the pattern but still failed to build are kept in a bounded
+    negative cache and are answered without another round trip.
+    """
+
+    CHORD_PATTERN = re.compile(
+        r"[A-H][b#]?"
+        r"(?:Ø|°7?|o7|Δ7?)?"
+        r"(?:sus|min|maj|m|M|[+-])?"
+        r"(?:dim|aug)?"
+        r"(?:\(?(?:[#b+-]|add|sus|no|omit|maj|M|/)?\d{1,2}(?!\d)\)?)*"
+        r"(?:/[A-H][b#+-]?)?"
+        r"\+?"
+    )
+    TONICS = frozenset('ABCDEFGH')
+    MAX_LENGTH = 128
+    MAX_NAME_LENGTH = 24
+    MAX_CACHE = 4096
+
+    def __init__(self, max_cache=MAX_CACHE):
+        self.max_cache = max_cache
+        self.invalid = dict()
+        self.accepted = 0
+        self.rejected = 0
+        self.cache_hits = 0
+
+    def is_chord(self, name):
+        return (
+            0 < len(name) <= self.MAX_NAME_LENGTH
+            and name[0] in self.TONICS
+            and self.CHORD_PATTERN.fullmatch(name) is not None
+            and name not in self.invalid
+        )
+
+    def split(self, text):
+        """ chord names if every comma separated part looks like a chord, else None """
+        stripped = text.lstrip()
+        if not stripped or len(text) > self.MAX_LENGTH or stripped[0] not in self.TONICS:
+            self.rejected += 1
+            return None
+        if text in self.invalid:
+            self.cache_hits += 1
+            self.rejected += 1
+            return None
+        names = [name.strip() for name in text.split(',')]
+        if all(self.is_chord(name) for name in names):
+            self.accepted += 1
+            return names
+        self.rejected += 1
+        self.remember(text)
+        return None
+
+    def remember(self, text):
+        """ negative cache for junk and for names that failed to parse or build on their own """
+        if len(self.invalid) >= self.max_cache:
+            self.invalid.clear()
+        self.invalid[text] = True
+
+    @property
+    def counters(self):
+        return dict(accepted=self.accepted, rejected=self.rejected, cache_hits=self.cache_hits)
@@ -0,0 +1,243 @@
+from concurrent.futures import Future
+from collections import deque
+from telegram import InputMediaPhoto
+from telegram.error import RetryAfter
+import threading
+import logging
+import heapq
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ `rate` sends per second with bursts up to `capacity`, paused on flood-wait """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now):
+        self.refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(now + wait, self.paused_until)
+
+    def consume(self, n=1):
+        self.tokens -= n
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        """ full and not paused, the same as a new bucket """
+        self.refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class Sender:
+    """
+    Outbound messages go through per-chat queues served by a small pool of threads.
+    One chat is served by one thread at a time, so messages of a chat keep their order,
+    while different chats are sent concurrently over the bot's pooled connections.
+    Consecutive photos of a chat are sent as one media group. Every chat and the bot
+    as a whole have token buckets, a flood-wait answer pauses the chat for retry_after
+    and the messages are sent again.
+
+    send_* return Futures with the sent Message.
+    """
+
+    WORKERS = 8
+    CHAT_RATE = 1.0
+    CHAT_BURST = 3
+    GLOBAL_RATE = 30.0
+    MEDIA_GROUP = 10
+    MAX_RETRIES = 5
+    STOP_TIMEOUT = 10.0
+    # seconds between sweeps of idle chat buckets
+    SWEEP_INTERVAL = 60.0
+
+    def __init__(self, bot, workers=WORKERS, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, global_rate=GLOBAL_RATE):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.queues = dict()
+        self.buckets = dict()
+        self.swept = time.monotonic()
+        self.bucket = TokenBucket(global_rate, global_rate)
+        # (ready time, sequence, chat_id) of chats with messages and no thread on them
+        self.schedule = list()
+        self.scheduled = set()
+        self.sequence = 0
+        self.retried = 0
+        self.running = False
+        self._cond = threading.Condition()
+        self._threads = list()
+
+    def start(self):
+        self.running = True
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """ send what is queued for up to `timeout` seconds, messages left after that fail """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.queues and self._threads:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            self.running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = list()
+        with self._cond:
+            dropped = [item for queue in self.queues.values() for item in queue]
+            self.queues.clear()
+            self.schedule = list()
+            self.scheduled.clear()
+        if dropped:
+            logger.warning('sender stopped with %d messages unsent', len(dropped))
+        for item in dropped:
+            item[3].set_exception(RuntimeError('sender stopped'))
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.put(chat_id, 'message', text, kwargs)
+
+    def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        """ photo is a file_id or a file object, the latter is rewound on retries """
+        return self.put(chat_id, 'photo', photo, dict(kwargs, caption=caption))
+
+    def send_all(self, chat_id, messages):
+        """
+        queue ('message', text, kwargs) and ('photo', photo, kwargs) at once,
+        so that their photos can be grouped
+        """
+        futures = [Future() for _ in messages]
+        with self._cond:
+            queue = self.queues.setdefault(chat_id, deque())
+            for (kind, content, kwargs), future in zip(messages, futures):
+                queue.append([kind, content, kwargs, future, 0])
+            if chat_id not in self.scheduled and queue:
+                self.reschedule(chat_id, time.monotonic())
+        return futures
+
+    def put(self, chat_id, kind, content, kwargs):
+        return self.send_all(chat_id, [(kind, content, kwargs)])[0]
+
+    def pending(self):
+        """ messages queued and not sent yet """
+        with self._cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def reschedule(self, chat_id, ready_at):
+        self.sequence += 1
+        heapq.heappush(self.schedule, (ready_at, self.sequence, chat_id))
+        self.scheduled.add(chat_id)
+        self._cond.notify()
+
+    def take(self):
+        """ wait for a chat that may send now, returns its batch of messages """
+        with self._cond:
+            while self.running:
+                now = time.monotonic()
+                if not self.schedule:
+                    self._cond.wait()
+                    continue
+                ready_at = max(self.schedule[0][0], self.bucket.ready_at(now))
+                if ready_at > now:
+                    self._cond.wait(ready_at - now)
+                    continue
+                _, _, chat_id = heapq.heappop(self.schedule)
+                bucket = self.buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+                ready_at = bucket.ready_at(now)
+                if ready_at > now:
+                    # let other chats go first
+                    self.sequence += 1
+                    heapq.heappush(self.schedule, (ready_at, self.sequence, chat_id))
+                    continue
+                queue = self.queues[chat_id]
+                batch = [queue.popleft()]
+                if batch[0][0] == 'photo':
+                    while queue and queue[0][0] == 'photo' and len(batch) < self.MEDIA_GROUP:
+                        batch.append(queue.popleft())
+                bucket.consume(len(batch))
+                self.bucket.consume(len(batch))
+                return chat_id, batch
+        return None, None
+
+    def done(self, chat_id, retry=(), delay=0):
+        with self._cond:
+            queue = self.queues[chat_id]
+            queue.extendleft(reversed(retry))
+            if queue:
+                self.reschedule(chat_id, time.monotonic() + delay)
+            else:
+                self.scheduled.discard(chat_id)
+                del self.queues[chat_id]
+                # stop() waits for the queues to empty
+                self._cond.notify_all()
+            self.sweep(time.monotonic())
+
+    def sweep(self, now):
+        """ forget buckets of chats that have nothing queued and could send a full burst again """
+        if now - self.swept < self.SWEEP_INTERVAL:
+            return
+        self.swept = now
+        for chat_id in [c for c, bucket in self.buckets.items() if c not in self.queues and bucket.idle(now)]:
+            del self.buckets[chat_id]
+
+    def work(self):
+        while True:
+            chat_id, batch = self.take()
+            if chat_id is None:
+                return
+            try:
+                results = self.send(chat_id, batch)
+            except RetryAfter as e:
+                with self._cond:
+                    self.retried += 1
+                    self.buckets[chat_id].pause(e.retry_after)
+                retry = list()
+                for item in batch:
+                    item[4] += 1
+                    if item[4] > self.MAX_RETRIES:
+                        item[3].set_exception(e)
+                    else:
+                        retry.append(item)
+                self.done(chat_id, retry=retry, delay=e.retry_after)
+            except Exception as e:
+                logger.warning('failed to send to %s: %s', chat_id, e)
+                for item in batch:
+                    item[3].set_exception(e)
+                self.done(chat_id)
+            else:
+                for item, result in zip(batch, results):
+                    item[3].set_result(result)
+                self.done(chat_id)
+
+    def send(self, chat_id, batch):
+        for kind, content, kwargs, _, _ in batch:
+            if hasattr(content, 'seek'):
+                content.seek(0)
+        kind, content, kwargs, _, _ = batch[0]
+        if kind == 'message':
+            return [self.bot.send_message(chat_id, content, **kwargs)]
+        if len(batch) == 1:
+            return [self.bot.send_photo(chat_id, content, **kwargs)]
+        media = [InputMediaPhoto(content, caption=kwargs.get('caption')) for _, content, kwargs, _, _ in batch]
+        reply = {name: kwargs[name] for name in ('reply_to_message_id', 'allow_sending_without_reply') if name in kwargs}
+        return self.bot.send_media_group(chat_id, media, **reply)
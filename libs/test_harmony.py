@@ -0,0 +1,48 @@
+import pytest
+
+from libs.harmony import Harmony
+
+
+@pytest.mark.parametrize('tonic, mode, scale', [
+    ('C', 'major', 'C D E F G A B'),
+    ('A', 'minor', 'A B C D E F G'),
+    ('F', 'major', 'F G A Bb C D E'),
+    ('D', 'minor', 'D E F G A Bb C'),
+    ('D', 'dorian', 'D E F G A B C'),
+    ('G', 'mixolydian', 'G A B C D E F'),
+    ('Eb', 'major', 'Eb F G Ab Bb C D'),
+])
+def test_scale(tonic, mode, scale):
+    assert Harmony(tonic, mode).scale == scale.split()
+
+
+@pytest.mark.parametrize('tonic, mode', [('F#', 'major'), ('D#', 'minor'), ('C#', 'major'), ('G#', 'dorian')])
+def test_sharp_tonics_keep_sharps(tonic, mode):
+    harmony = Harmony(tonic, mode)
+    assert harmony.tonic == tonic
+    assert not any('b' in name for name in harmony.scale)
+
+
+def test_table():
+    assert [numeral for _, (_, numeral), _ in Harmony.TABLE['ionian']] == ['I', 'ii', 'iii', 'IV', 'V', 'vi', 'vii°']
+    assert [numeral for _, _, (_, numeral) in Harmony.TABLE['ionian']] == \
+        ['Imaj7', 'ii7', 'iii7', 'IVmaj7', 'V7', 'vi7', 'viiø7']
+    assert [numeral for _, (_, numeral), _ in Harmony.TABLE['aeolian']] == ['i', 'ii°', 'III', 'iv', 'v', 'VI', 'VII']
+
+
+def test_chords():
+    assert [name for _, name, _, _ in Harmony('C').chords()] == ['C', 'Dm', 'Em', 'F', 'G', 'Am', 'Bdim']
+    assert [name for _, name, _, _ in Harmony('A', 'minor').chords(sevenths=True)] == \
+        ['Am7', 'Bm7b5', 'Cmaj7', 'Dm7', 'Em7', 'Fmaj7', 'G7']
+
+
+def test_mode_name_is_echoed():
+    assert str(Harmony('A', 'Minor')) == 'A minor: A B C D E F G'
+    assert str(Harmony('D', 'dorian')) == 'D dorian: D E F G A B C'
+    assert Harmony('C', 'major').mode == 'ionian'
+
+
+@pytest.mark.parametrize('tonic, mode', [('C', 'blues'), ('H', 'major')])
+def test_unknown(tonic, mode):
+    with pytest.raises(ValueError):
+        Harmony(tonic, mode)
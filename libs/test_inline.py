@@ -0,0 +1,39 @@
+import threading
+
+from libs.inline import ChordIndex
+
+
+def test_photos():
+    index = ChordIndex(['Am', 'Am7', 'A7'])
+    index.add_photo('Am', 'id-am', title='Am: A C E')
+    assert index.get_photo('Am') == 'id-am'
+    assert index.get_title('Am') == 'Am: A C E'
+    assert index.get_photo('Am', tuning='DADGAD') is None
+    assert index.cached('am') == [('Am', 'id-am')]
+    assert index.suggest('Am') == 'Am7'
+
+
+def test_start_parameter():
+    for name in ('Am', 'F#m7b5', 'C6/9'):
+        assert ChordIndex.from_start_parameter(ChordIndex.start_parameter(name)) == name
+    assert ChordIndex.from_start_parameter('hello') is None
+
+
+def test_concurrent_add_and_query():
+    index = ChordIndex(['A'])
+    names = ['A{}'.format(n) for n in range(2000)]
+    errors = list()
+
+    def query():
+        try:
+            while len(index.cached('A', limit=5000)) < len(names):
+                pass
+        except Exception as e:
+            errors.append(e)
+
+    reader = threading.Thread(target=query)
+    reader.start()
+    for n, name in enumerate(names):
+        index.add_photo(name, 'id{}'.format(n))
+    reader.join(10)
+    assert errors == []
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from libs.inline import ChordIndex
+from libs.prefilter import ChordFilter
+
+
+@pytest.mark.parametrize('name', [
+    'Am', 'Am7', 'Dsus4/B', 'C6/9', 'Bbmaj7#11/F', 'Am7(b5)', 'HØ', 'C°7', 'DΔ7', 'CM7', 'E+', 'C7+', 'F#m7-5',
+])
+def test_accepts_chords(name):
+    assert ChordFilter().is_chord(name)
+
+
+def test_accepts_vocabulary():
+    f = ChordFilter()
+    assert [name for name in ChordIndex.vocabulary() if not f.is_chord(name)] == []
+
+
+@pytest.mark.parametrize('text', ['hello', 'A nice day', 'Also', 'Am, lol', 'ok', '', '   ', 'C' + '1' * 30])
+def test_rejects_conversation(text):
+    assert ChordFilter().split(text) is None
+
+
+def test_split():
+    assert ChordFilter().split('Am, Dm , E') == ['Am', 'Dm', 'E']
+
+
+def test_counters_and_negative_cache():
+    f = ChordFilter()
+    f.split('Am')
+    f.split('Also')
+    f.split('Also')
+    f.split('nope')
+    assert f.counters == dict(accepted=1, rejected=3, cache_hits=1)
+
+    f.remember('Cx9')
+    assert not f.is_chord('Cx9')
+
+
+def test_negative_cache_is_bounded():
+    f = ChordFilter(max_cache=2)
+    for text in ('A1x', 'A2x', 'A3x'):
+        f.remember(text)
+    assert len(f.invalid) <= 2
+
+
+@pytest.mark.parametrize('text', [
+    'C' + '1' * 21 + 'x',
+    'C' + '1' * 22,
+    'C' + '7b' * 11 + 'x',
+    'Am' + '(1' * 11 + 'x',
+])
+def test_pathological_input_is_linear(text):
+    f = ChordFilter()
+    start = time.perf_counter()
+    for _ in range(100):
+        f.is_chord(text)
+        f.split(text)
+    assert time.perf_counter() - start < 0.1
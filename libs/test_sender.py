@@ -0,0 +1,135 @@
+import threading
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from libs.sender import Sender, TokenBucket
+
+
+class FakeBot:
+    """ records calls, `flood` maps chat_id to the number of RetryAfter answers it gets first """
+
+    def __init__(self, flood=None, delay=0):
+        self.calls = list()
+        self.flood = dict(flood or {})
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def call(self, method, chat_id, content, kwargs):
+        time.sleep(self.delay)
+        with self._lock:
+            if self.flood.get(chat_id):
+                self.flood[chat_id] -= 1
+                raise RetryAfter(0.05)
+            self.calls.append((method, chat_id, content, kwargs))
+        return content
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.call('send_message', chat_id, text, kwargs)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self.call('send_photo', chat_id, photo, kwargs)
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        return self.call('send_media_group', chat_id, [m.media for m in media], kwargs)
+
+
+def sender(bot, **kwargs):
+    kwargs = dict(dict(workers=4, chat_rate=1000, chat_burst=1000, global_rate=1000), **kwargs)
+    return Sender(bot, **kwargs).start()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated
+    assert bucket.ready_at(now) == now
+    bucket.consume(2)
+    assert bucket.ready_at(now) == pytest.approx(now + 0.5)
+    assert bucket.ready_at(now + 1) == now + 1
+    bucket.pause(10)
+    assert bucket.ready_at(now + 1) >= now + 10
+
+
+def test_chat_order():
+    bot = FakeBot(delay=0.001)
+    s = sender(bot)
+    futures = [s.send_message(chat_id, i) for i in range(20) for chat_id in (1, 2, 3)]
+    assert [f.result(5) for f in futures] == [i for i in range(20) for _ in (1, 2, 3)]
+    s.stop()
+    for chat_id in (1, 2, 3):
+        assert [content for _, c, content, _ in bot.calls if c == chat_id] == list(range(20))
+
+
+def test_photos_are_grouped():
+    bot = FakeBot()
+    s = Sender(bot)
+    futures = s.send_all(1, [('message', 'text', {}), ('photo', 'a', dict(caption='A')), ('photo', 'b', {})])
+    s.start()
+    assert [f.result(5) for f in futures] == ['text', 'a', 'b']
+    s.stop()
+    assert [(method, content) for method, _, content, _ in bot.calls] == \
+        [('send_message', 'text'), ('send_media_group', ['a', 'b'])]
+
+
+def test_flood_wait_is_retried():
+    bot = FakeBot(flood={1: 2})
+    s = sender(bot)
+    futures = [s.send_message(1, i) for i in range(3)] + [s.send_message(2, 'other')]
+    assert [f.result(5) for f in futures] == [0, 1, 2, 'other']
+    s.stop()
+    assert s.retried == 2
+    assert [content for _, chat_id, content, _ in bot.calls if chat_id == 1] == [0, 1, 2]
+    # the other chat is not held back by the paused one
+    assert bot.calls[0][1] == 2
+
+
+def test_retries_give_up():
+    bot = FakeBot(flood={1: Sender.MAX_RETRIES + 1})
+    s = sender(bot)
+    with pytest.raises(RetryAfter):
+        s.send_message(1, 'text').result(5)
+    s.stop()
+
+
+def test_stop_sends_queued():
+    bot = FakeBot()
+    s = sender(bot, chat_rate=50, chat_burst=1)
+    futures = [s.send_message(1, i) for i in range(10)]
+    s.stop()
+    assert [f.result(0) for f in futures] == list(range(10))
+
+
+def test_stop_fails_what_is_left():
+    bot = FakeBot()
+    s = sender(bot, chat_rate=1, chat_burst=1)
+    futures = [s.send_message(1, i) for i in range(3)]
+    s.stop(timeout=0.1)
+    assert futures[0].result(0) == 0
+    for f in futures[1:]:
+        with pytest.raises(RuntimeError):
+            f.result(0)
+    assert not s.queues
+
+
+def test_media_group_keeps_reply():
+    bot = FakeBot()
+    s = Sender(bot)
+    futures = s.send_all(1, [('photo', 'a', dict(caption='A', reply_to_message_id=7)), ('photo', 'b', {})])
+    s.start()
+    [f.result(5) for f in futures]
+    s.stop()
+    assert bot.calls == [('send_media_group', 1, ['a', 'b'], dict(reply_to_message_id=7))]
+
+
+def test_idle_buckets_are_forgotten():
+    bot = FakeBot()
+    s = sender(bot, chat_rate=1000, chat_burst=1)
+    s.SWEEP_INTERVAL = 0
+    [f.result(5) for f in [s.send_message(chat_id, 'text') for chat_id in range(5)]]
+    s.buckets[0].pause(60)
+    time.sleep(0.01)
+    with s._cond:
+        s.sweep(time.monotonic())
+    s.stop()
+    assert list(s.buckets) == [0]
@@ -0,0 +1,66 @@
+from logging.handlers import QueueHandler, QueueListener
+import logging
+import queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    """
+    Steps of a chord construction, kept as plain tuples and formatted only when emitted.
+    Traces exist only while debug logging is on, see `Trace.start`.
+    """
+
+    TEMPLATES = {
+        'input': '{detail}',
+        'replaced': 'Pattern "{detail[0]}": Replaced {detail[1]} to {detail[2]}',
+        'tonic': ' {step} {note} tonic',
+        'added': ' {step} {note} added',
+        'enlarged': '♯{step} {note} enlarged',
+        'reduced': '♭{step} {note} reduced',
+        'missing': 'no step {step} to {detail}',
+        'suspended': ' {step} {note} suspended to {detail}',
+        'omitted': ' {step} {note} omitted',
+        'result': '→ {detail}',
+    }
+
+    def __init__(self):
+        self.steps = list()
+
+    @classmethod
+    def start(cls):
+        """ a new trace if tracing is enabled, else None """
+        if logger.isEnabledFor(logging.DEBUG):
+            return cls()
+        return None
+
+    def step(self, action, step=None, note=None, detail=None):
+        # notes change in place while a chord is built, keep their name
+        self.steps.append((action, step, None if note is None else str(note), detail))
+
+    def emit(self):
+        logger.debug('%s', self)
+
+    def __iter__(self):
+        for action, step, note, detail in self.steps:
+            yield self.TEMPLATES[action].format(step=step, note=note, detail=detail)
+
+    def __str__(self):
+        return '\n'.join(self)
+
+
+def setup_logging(level='WARNING'):
+    """
+    Log records go through a queue and are written by a listener thread,
+    so handlers never block on stdout. Returns the started listener.
+    """
+    records = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = QueueListener(records, stream, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(records)]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    listener.start()
+    return listener